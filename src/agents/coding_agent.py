@@ -1,10 +1,47 @@
-import os
+import asyncio
+import hashlib
+import re
 from pathlib import Path
-from dotenv import load_dotenv
-from openai import OpenAI
+from typing import List
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from src.services import llm_cache
+from src.services.openai_client import acollect_stream, async_client, client, collect_stream
+from src.services.patch_service import PatchError, apply_unified_diff
+
+MODEL = "gpt-4o"
+TEMPERATURE = 0.2
+
+# Files larger than this (in characters) are edited via a unified diff instead of a
+# full rewrite, so output tokens scale with the size of the change, not the file.
+DIFF_MODE_THRESHOLD = 4000
+
+# Files larger than this are shown to the model as an excerpt (the head plus the
+# regions mentioning words from the instruction) and can only be edited via diff.
+MAX_PROMPT_CHARS = 32_000
+_EXCERPT_HEAD_LINES = 80
+_EXCERPT_CONTEXT_LINES = 30
+_KEYWORD_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]{3,}")
+_STOPWORDS = frozenset([
+    "this", "that", "with", "from", "into", "should", "would", "could", "when",
+    "then", "than", "them", "they", "have", "make", "add", "update", "change",
+    "file", "code", "please", "also", "each", "every", "only", "some", "which",
+])
+
+# Kept byte-identical across calls so OpenAI's automatic prompt caching can reuse the prefix
+SYSTEM_PROMPT = (
+    "You are CodePilot AI Coding Agent. "
+    "You receive a source file and a requested change, and you must return the FULL updated file content. "
+    "Do not explain. Do not add comments unless explicitly asked. "
+    "Just return the updated code."
+)
+
+DIFF_SYSTEM_PROMPT = (
+    "You are CodePilot AI Coding Agent. "
+    "You receive a source file and a requested change, and you must return a unified diff patch "
+    "(---/+++/@@ hunks with 3 lines of context) that, when applied to the file, implements the change. "
+    "Do not explain. Do not add comments unless explicitly asked. "
+    "No prose, only the patch."
+)
 
 
 def _strip_code_fences(text: str) -> str:
@@ -23,40 +60,237 @@ def _strip_code_fences(text: str) -> str:
     return text
 
 
-def generate_updated_file_content(
+def _excerpt(original_content: str, instruction: str) -> str:
+    """
+    Head of the file plus +-_EXCERPT_CONTEXT_LINES around lines mentioning any
+    instruction keyword, capped near MAX_PROMPT_CHARS. Omitted ranges are marked
+    with their 1-based line numbers so the model can write correct hunk headers.
+    """
+    lines = original_content.splitlines()
+    keep = set(range(min(_EXCERPT_HEAD_LINES, len(lines))))
+    budget = sum(len(lines[i]) + 1 for i in keep)
+
+    words = {w.lower() for w in _KEYWORD_RE.findall(instruction)} - _STOPWORDS
+    if words:
+        pattern = re.compile(
+            "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True)),
+            re.IGNORECASE,
+        )
+        for i, line in enumerate(lines):
+            if budget >= MAX_PROMPT_CHARS:
+                break
+            if not pattern.search(line):
+                continue
+            for j in range(max(0, i - _EXCERPT_CONTEXT_LINES), min(len(lines), i + _EXCERPT_CONTEXT_LINES + 1)):
+                if j not in keep:
+                    keep.add(j)
+                    budget += len(lines[j]) + 1
+
+    out: List[str] = []
+    prev = -1
+    for i in sorted(keep):
+        if i != prev + 1:
+            out.append(f"... [lines {prev + 2}-{i} omitted] ...")
+        out.append(lines[i])
+        prev = i
+    if prev < len(lines) - 1:
+        out.append(f"... [lines {prev + 2}-{len(lines)} omitted] ...")
+    return "\n".join(out)
+
+
+def _build_messages(
     original_content: str,
     file_path: str,
     instruction: str,
-    language_hint: str | None = None,
-) -> str:
+    language_hint: str | None,
+    diff_mode: bool = False,
+    truncated: bool = False,
+) -> List[dict]:
     lang_label = language_hint or ""
-    system_prompt = (
-        "You are CodePilot AI Coding Agent. "
-        "You receive a source file and a requested change, and you must return the FULL updated file content. "
-        "Do not explain. Do not add comments unless explicitly asked. "
-        "Just return the updated code."
+    output_rule = (
+        "Return ONLY the unified diff. Do NOT wrap it in ``` or any extra text."
+        if diff_mode
+        else "Return ONLY the updated file content. Do NOT wrap it in ``` or any extra text."
     )
 
+    # Large, slowly-varying file body first and the per-call instruction last,
+    # so repeated edits to the same file share the longest possible cached prefix.
+    if truncated:
+        header = (
+            f"CURRENT FILE EXCERPT ({file_path}; omitted regions are marked "
+            "'... [lines a-b omitted] ...', take hunk context only from shown lines):\n"
+        )
+        body = _excerpt(original_content, instruction)
+    else:
+        header = f"CURRENT FILE CONTENTS ({file_path}):\n"
+        body = original_content
+
     user_prompt = (
-        f"File path: {file_path}\n"
-        f"Language: {lang_label}\n\n"
-        f"Current file content:\n"
+        f"{header}"
         f"```{lang_label}\n"
-        f"{original_content}\n"
+        f"{body}\n"
         f"```\n\n"
-        f"Change request:\n"
+        "---\n"
+        f"Language: {lang_label}\n"
+        f"CHANGE REQUEST:\n"
         f"{instruction}\n\n"
-        "Return ONLY the updated file content. Do NOT wrap it in ``` or any extra text."
+        f"{output_rule}"
     )
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.2,
-    )
+    return [
+        {"role": "system", "content": DIFF_SYSTEM_PROMPT if diff_mode else SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _cache_key(messages: List[dict]) -> str:
+    return llm_cache.make_key(*(m["content"] for m in messages), MODEL, TEMPERATURE)
+
+
+def _edit_key(original_content: str, file_path: str, instruction: str, language_hint: str | None) -> str:
+    """
+    Coarse key for a whole edit: same file, same contents, same instruction.
+    Checked before any prompt is built; maps straight to the final file content.
+    """
+    content_hash = hashlib.blake2b(original_content.encode("utf-8"), digest_size=32).hexdigest()
+    return llm_cache.make_key("edit", file_path, instruction, language_hint or "", content_hash, MODEL)
+
+
+def _to_file_content(content: str, original_content: str, diff_mode: bool) -> str:
+    """
+    Turns raw model output into the new file content. Raises PatchError if a
+    diff-mode response does not apply.
+    """
+    text = _strip_code_fences(content)
+    if diff_mode:
+        return apply_unified_diff(original_content, text)
+    return text
+
+
+def _complete(
+    original_content: str,
+    file_path: str,
+    instruction: str,
+    language_hint: str | None,
+    diff_mode: bool,
+    truncated: bool = False,
+) -> str:
+    messages = _build_messages(original_content, file_path, instruction, language_hint, diff_mode, truncated)
+
+    # Identical prompt -> identical edit; skip the API call entirely on a hit
+    cache_key = _cache_key(messages)
+    content = llm_cache.cache_get(cache_key)
+    from_cache = content is not None
+
+    if not from_cache:
+        response = client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            temperature=TEMPERATURE,
+            stream=True,
+        )
+        content = collect_stream(response)
+
+    result = _to_file_content(content, original_content, diff_mode)
+    if not from_cache and content.strip():
+        llm_cache.cache_set(cache_key, content)
+    return result
+
+
+async def _acomplete(
+    original_content: str,
+    file_path: str,
+    instruction: str,
+    language_hint: str | None,
+    diff_mode: bool,
+    truncated: bool = False,
+) -> str:
+    messages = _build_messages(original_content, file_path, instruction, language_hint, diff_mode, truncated)
+
+    # Disk cache I/O runs on a worker thread, never on the event loop
+    cache_key = _cache_key(messages)
+    content = await asyncio.to_thread(llm_cache.cache_get, cache_key)
+    from_cache = content is not None
+
+    if not from_cache:
+        response = await async_client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            temperature=TEMPERATURE,
+            stream=True,
+        )
+        content = await acollect_stream(response)
+
+    result = _to_file_content(content, original_content, diff_mode)
+    if not from_cache and content.strip():
+        await asyncio.to_thread(llm_cache.cache_set, cache_key, content)
+    return result
+
+
+def generate_updated_file_content(
+    original_content: str,
+    file_path: str,
+    instruction: str,
+    language_hint: str | None = None,
+) -> str:
+    # Re-applying the same instruction to the same file contents: reuse the prior result
+    edit_key = _edit_key(original_content, file_path, instruction, language_hint)
+    cached = llm_cache.cache_get(edit_key)
+    if cached is not None:
+        return cached
+
+    # Very large files are only ever shown as an excerpt, so a diff is the only option
+    truncated = len(original_content) > MAX_PROMPT_CHARS
+    result = None
+    if len(original_content) > DIFF_MODE_THRESHOLD:
+        try:
+            result = _complete(
+                original_content, file_path, instruction, language_hint, diff_mode=True, truncated=truncated
+            )
+        except PatchError:
+            if truncated:
+                raise
+            # fall back to a full-file rewrite
+
+    if result is None:
+        result = _complete(original_content, file_path, instruction, language_hint, diff_mode=False)
+
+    if result.strip():
+        llm_cache.cache_set(edit_key, result)
+    return result
+
+
+async def agenerate_updated_file_content(
+    original_content: str,
+    file_path: str,
+    instruction: str,
+    language_hint: str | None = None,
+) -> str:
+    """
+    Async variant of `generate_updated_file_content`, so several files can be
+    generated concurrently without holding a worker thread per LLM call.
+    """
+    edit_key = _edit_key(original_content, file_path, instruction, language_hint)
+    cached = await asyncio.to_thread(llm_cache.cache_get, edit_key)
+    if cached is not None:
+        return cached
+
+    # Very large files are only ever shown as an excerpt, so a diff is the only option
+    truncated = len(original_content) > MAX_PROMPT_CHARS
+    result = None
+    if len(original_content) > DIFF_MODE_THRESHOLD:
+        try:
+            result = await _acomplete(
+                original_content, file_path, instruction, language_hint, diff_mode=True, truncated=truncated
+            )
+        except PatchError:
+            if truncated:
+                raise
+            # fall back to a full-file rewrite
+
+    if result is None:
+        result = await _acomplete(original_content, file_path, instruction, language_hint, diff_mode=False)
 
-    content = response.choices[0].message.content or ""
-    return _strip_code_fences(content)
+    if result.strip():
+        await asyncio.to_thread(llm_cache.cache_set, edit_key, result)
+    return result
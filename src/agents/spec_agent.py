@@ -1,13 +1,38 @@
 # src/agents/spec_agent.py
 
-import json
-from typing import Dict, Any, List
+import os
+from typing import Dict, Any, FrozenSet, List, Optional, Tuple
 from pathlib import Path
+from uuid import uuid4
 
-from src.services.git_service import ensure_repo_cloned, run_git_command
+import orjson
+
+from src.models.task_spec import TaskSpec, utc_now_iso
+from src.services import semantic_cache
+from src.services.git_service import ensure_repo_cloned, list_tracked_files, repo_lock, tracked_file_set
 from src.services.openai_client import chat_completion_json  # <-- adjust import if your project differs
 
 
+# Cheap model first; escalate only when its output is unusable
+SPEC_AGENT_MODEL = os.getenv("SPEC_AGENT_MODEL", "gpt-4o-mini")
+SPEC_AGENT_FALLBACK_MODEL = os.getenv("SPEC_AGENT_FALLBACK_MODEL", "gpt-4o")
+
+# Only files the agent can plausibly edit are shown to the model (fewer prompt tokens)
+_SRC_EXTS = frozenset([
+    ".java", ".py", ".ts", ".js", ".tsx", ".jsx", ".go", ".rs", ".kt", ".md",
+    ".yaml", ".yml", ".json", ".xml", ".gradle", ".properties",
+])
+# Build output/dependency dirs, skipped only directly under the repo root or a
+# module root (a dir with a build file), so e.g. a `build` Java package is kept
+_SKIP_DIRS = frozenset(["target", "build", "node_modules", ".gradle"])
+_BUILD_FILES = frozenset(["pom.xml", "build.gradle", "build.gradle.kts", "package.json"])
+
+# Static backend-managed fields of every new task (same values TaskSpec.create_default uses)
+_DEFAULT_BASE = {
+    "target_repo": os.getenv("TARGET_REPO_URL", ""),
+    "target_branch": os.getenv("TARGET_REPO_BRANCH", "master"),
+}
+
 SPEC_SCHEMA_EXAMPLE = {
     "title": "Short task title",
     "description": "Clear description of what to change",
@@ -15,27 +40,103 @@ SPEC_SCHEMA_EXAMPLE = {
 }
 
 
-def _get_repo_file_list(repo_path: Path, limit: int = 3000) -> List[str]:
+def _get_repo_file_list(repo_path: Path, limit: int = 3000) -> Tuple[List[str], FrozenSet[str]]:
     """
-    Get tracked files from the repo using `git ls-files`.
+    Get tracked files from the repo (`git ls-files`, cached until the index changes).
+    Returns (files to show the LLM, set of all tracked paths for validation).
+    Binary/build artifacts are filtered out of the LLM list.
     """
-    p = run_git_command(["git", "ls-files"], cwd=str(repo_path), allow_fail=False)
-    files = [line.strip() for line in (p.stdout or "").splitlines() if line.strip()]
+    all_files = list_tracked_files(repo_path)
+    module_roots = _module_roots(all_files)
+    files = [
+        p for p in all_files
+        if os.path.splitext(p)[1].lower() in _SRC_EXTS and not _in_build_dir(p, module_roots)
+    ]
     # Avoid sending extremely large lists to LLM
-    return files[:limit]
+    return (files or list(all_files))[:limit], tracked_file_set(repo_path)
+
 
+def _module_roots(paths: Tuple[str, ...]) -> FrozenSet[str]:
+    # "" is the repo root; every dir holding a build file is a module root
+    roots = {""}
+    for p in paths:
+        head, _, name = p.rpartition("/")
+        if name in _BUILD_FILES:
+            roots.add(head)
+    return frozenset(roots)
 
-def generate_task_spec(user_message: str) -> Dict[str, Any]:
+
+def _in_build_dir(path: str, module_roots: FrozenSet[str]) -> bool:
+    parts = path.split("/")
+    for i, part in enumerate(parts[:-1]):
+        if part in _SKIP_DIRS and "/".join(parts[:i]) in module_roots:
+            return True
+    return False
+
+
+def _clean_affected_files(spec: Dict[str, Any], repo_set: FrozenSet[str]) -> List[str]:
+    """
+    Keep only affected_files entries that are real tracked paths.
+    """
+    files = spec.get("affected_files")
+    if not isinstance(files, list):
+        # Missing, null or a bare string in the model output
+        return []
+    stripped = (f.strip() for f in files if isinstance(f, str))
+    return [f for f in stripped if f in repo_set]
+
+
+def _has_spec_schema(spec: Dict[str, Any]) -> bool:
+    """
+    True if the model output matches SPEC_SCHEMA_EXAMPLE's types: string title and
+    description, list of affected_files (null/missing values do not count).
+    """
+    return (
+        isinstance(spec.get("title"), str)
+        and isinstance(spec.get("description"), str)
+        and isinstance(spec.get("affected_files"), list)
+    )
+
+
+def _call_spec_models(system: str, user: Dict[str, Any], repo_set: FrozenSet[str]) -> Dict[str, Any]:
+    """
+    Model cascade: try SPEC_AGENT_MODEL, and retry with SPEC_AGENT_FALLBACK_MODEL
+    if the output is not a JSON object, does not match the spec schema, or names
+    no existing files. A well-formed answer is preferred over a malformed one.
+    """
+    spec: Optional[Dict[str, Any]] = None
+    for model in dict.fromkeys([SPEC_AGENT_MODEL, SPEC_AGENT_FALLBACK_MODEL]):
+        try:
+            candidate = chat_completion_json(system_prompt=system, user_payload=user, model=model)
+        except orjson.JSONDecodeError:
+            continue
+        if not isinstance(candidate, dict):
+            continue
+        well_formed = _has_spec_schema(candidate)
+        if spec is None or well_formed:
+            spec = candidate
+        if well_formed and _clean_affected_files(spec, repo_set):
+            break
+
+    if spec is None:
+        raise RuntimeError("Spec agent returned non-dict output")
+    return spec
+
+
+def generate_task_spec(user_message: str, source: str = "CodePilot AI User Portal") -> TaskSpec:
     """
     Generates a task spec, including affected_files.
     IMPORTANT: affected_files MUST exist in current repo.
-    """
 
-    # 1) Ensure repo exists locally
-    repo_path = ensure_repo_cloned()
+    Returns a TaskSpec ready for `save_task`: the model's title/description/
+    affected_files plus backend-managed fields (task_id, target_repo, created_at, source).
+    """
 
-    # 2) Extract real files list
-    repo_files = _get_repo_file_list(repo_path)
+    # 1) Ensure repo exists locally, and 2) extract real files list; one locked step,
+    # so another request cannot switch the working tree off the base branch in between
+    with repo_lock:
+        repo_path = ensure_repo_cloned()
+        repo_files, repo_set = _get_repo_file_list(repo_path)
 
     if not repo_files:
         raise RuntimeError("Repo file list is empty. Is the repo cloned correctly?")
@@ -48,6 +149,7 @@ def generate_task_spec(user_message: str) -> Dict[str, Any]:
         "1) 'affected_files' MUST ONLY contain file paths that exist in the repo file list provided.\n"
         "2) If you are not confident about file paths, choose the closest matching files from the list.\n"
         "3) Output MUST be valid JSON only (no markdown, no commentary).\n"
+        "4) Output a single JSON object.\n"
     )
 
     user = {
@@ -57,24 +159,27 @@ def generate_task_spec(user_message: str) -> Dict[str, Any]:
         "notes": "Choose 1-5 affected_files max. Prefer minimal changes.",
     }
 
-    # 4) Call model (JSON-only)
-    # chat_completion_json should return a Python dict (parsed JSON)
-    spec = chat_completion_json(system_prompt=system, user_payload=user)
-
-    # 5) Validate output minimally
-    if not isinstance(spec, dict):
-        raise RuntimeError("Spec agent returned non-dict output")
+    # 4) Reuse a spec from a paraphrased earlier request, otherwise call models (JSON-only)
+    # 5) Validate output minimally (non-dict / unparseable output escalates the cascade)
+    spec, embedding = semantic_cache.lookup(user_message)
+    from_cache = spec is not None
+    if not from_cache:
+        spec = _call_spec_models(system, user, repo_set)
 
-    spec.setdefault("title", "Untitled Task")
-    spec.setdefault("description", user_message.strip())
-    spec.setdefault("affected_files", [])
+    # Missing, null or non-string values get defaults (setdefault would keep a null)
+    if not isinstance(spec.get("title"), str):
+        spec["title"] = "Untitled Task"
+    if not isinstance(spec.get("description"), str):
+        spec["description"] = user_message.strip()
 
     # 6) Hard validation: affected_files must exist in repo_files
-    cleaned = []
-    repo_set = set(repo_files)
-    for f in spec.get("affected_files", []) or []:
-        if isinstance(f, str) and f.strip() in repo_set:
-            cleaned.append(f.strip())
+    cleaned = _clean_affected_files(spec, repo_set)
+
+    # Only remember specs that name real files; a fallback spec is not replayed
+    # to paraphrases (they get a fresh cascade run instead)
+    if cleaned and not from_cache:
+        spec["affected_files"] = cleaned
+        semantic_cache.store(user_message, embedding, spec)
 
     if not cleaned:
         # fallback: pick at least ONE file to prevent breaking pipeline
@@ -83,4 +188,11 @@ def generate_task_spec(user_message: str) -> Dict[str, Any]:
 
     spec["affected_files"] = cleaned
 
-    return spec
+    # 7) Add backend-managed fields; only schema keys are taken from the model output
+    return TaskSpec(
+        **{k: spec[k] for k in SPEC_SCHEMA_EXAMPLE},
+        **_DEFAULT_BASE,
+        task_id=uuid4().hex,
+        created_at=utc_now_iso(),
+        source=source,
+    )
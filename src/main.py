@@ -1,17 +1,40 @@
+import asyncio
+import functools
 import os
-from typing import Optional
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
-from datetime import datetime, timezone
 
-from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 
-from src.services.git_service import create_feature_branch, commit_and_push, ensure_repo_cloned
+from src.services.git_service import (
+    checkout_branch,
+    commit_changes,
+    create_feature_branch,
+    ensure_branch_ref,
+    ensure_repo_cloned,
+    list_files_at,
+    push_branch,
+    read_file_at,
+    repo_lock,
+)
+from src.services.patch_service import PatchError
 from src.services.test_service import run_tests_in_repo
-from src.agents.coding_agent import generate_updated_file_content
+from src.agents.coding_agent import agenerate_updated_file_content
 from src.agents.spec_agent import generate_task_spec
-from src.storage.task_storage import save_task, list_tasks, load_task, add_task_event
+from src.storage.task_storage import save_task, list_tasks, load_task
+from src.models.schemas import (
+    ApplyChangeResult,
+    ApplyTaskCodeRequest,
+    HealthStatus,
+    MessageInput,
+    PushStatus,
+    RunTestsRequest,
+    RunTestsResult,
+    TaskList,
+)
+from src.models.task_spec import TaskSpec, utc_now_iso
 
 
 # -----------------------------------------------------------------------------
@@ -33,52 +56,98 @@ app.add_middleware(
 )
 
 
-# -----------------------------------------------------------------------------
-# Request/Response models
-# -----------------------------------------------------------------------------
+# Max concurrent coding-agent calls across all requests (keeps us under OpenAI RPM/TPM limits)
+LLM_CONCURRENCY = 8
+_llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# File extension -> language label passed to the coding agent
+_EXT_LANG = {
+    ".java": "java",
+    ".py": "python",
+    ".md": "markdown",
+    ".js": "javascript",
+    ".jsx": "javascript",
+    ".ts": "typescript",
+    ".tsx": "typescript",
+    ".go": "go",
+    ".rs": "rust",
+    ".kt": "kotlin",
+    ".c": "c",
+    ".h": "c",
+    ".cpp": "cpp",
+    ".hpp": "cpp",
+}
 
-class HealthStatus(BaseModel):
-    status: str
 
+# -----------------------------------------------------------------------------
+# Helpers
+# -----------------------------------------------------------------------------
 
-class MessageInput(BaseModel):
-    message: str
+def _get_task_or_404(task_id: str) -> TaskSpec:
+    task = load_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
+    return task
 
 
-class ApplyTaskCodeRequest(BaseModel):
+def _append_event(task: TaskSpec, event: str, details: str) -> None:
     """
-    Optional inputs for apply-change.
-    We keep this minimal and stable (AI infers file from task spec).
+    Records a timeline event on the in-memory task; persisted by the handler's final save_task.
     """
-    language_hint: Optional[str] = None
-    branch_name: Optional[str] = None
+    task.timeline.append({"at": utc_now_iso(), "event": event, "details": details})
 
 
-class RunTestsRequest(BaseModel):
-    branch_name: str
-
-
-# -----------------------------------------------------------------------------
-# Helpers
-# -----------------------------------------------------------------------------
+def _finalize_apply(task: TaskSpec, branch_name: str, updated_files: List[str]) -> None:
+    """
+    Marks a task as applied: status, branch, run history and timeline, in one mutation.
+    """
+    now_iso = utc_now_iso()
+    task.status = "closed"
+    task.last_applied_branch = branch_name
+    task.last_applied_at = now_iso
+    task.run_history.append(
+        {"at": now_iso, "type": "apply_change", "branch": branch_name, "files": updated_files}
+    )
+    task.timeline.append(
+        {
+            "at": now_iso,
+            "event": "code_change_applied",
+            "details": f"Changes applied to {', '.join(updated_files)} on branch {branch_name}",
+        }
+    )
 
-def _utc_now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
 
+def _push_and_record(repo_path: Path, branch_name: str, task_id: str) -> None:
+    """
+    Background step of apply-change: pushes the branch, then records the outcome
+    on the task (push_status "pushed" / "failed") for GET /tasks/{id}/push-status.
+    save_task merges with the file on disk, so a handler still holding a copy
+    loaded before the push (e.g. run-tests) cannot revert this result.
+    """
+    try:
+        push_branch(repo_path, branch_name)
+        status, error = "pushed", None
+    except Exception as e:  # surfaced through push-status instead of a 500
+        status, error = "failed", str(e)
 
-def _get_task_or_404(task_id: str) -> dict:
     task = load_task(task_id)
     if not task:
-        raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
-    return task
+        return
+    task.push_status = status
+    task.push_error = error
+    if error is None:
+        _append_event(task, "pushed", f"Pushed changes on branch: {branch_name}")
+    else:
+        _append_event(task, "push_failed", f"Push failed for branch {branch_name}: {error}")
+    save_task(task)
 
 
-def _pick_target_file_from_task(task: dict) -> str:
+def _get_affected_files_from_task(task: TaskSpec) -> List[str]:
     """
-    Picks a file to modify from the task spec.
-    Expected: task contains 'affected_files': [ 'path/to/file', ... ]
+    Returns the files to modify from the task spec.
+    Expected: task.affected_files = [ 'path/to/file', ... ]
     """
-    affected = task.get("affected_files") or []
+    affected = task.affected_files
     if not affected:
         raise HTTPException(
             status_code=400,
@@ -88,7 +157,151 @@ def _pick_target_file_from_task(task: dict) -> str:
                 "or send repo_relative_path in request (not recommended)."
             ),
         )
-    return affected[0]
+    return affected
+
+
+def guess_language_from_extension(path: str) -> Optional[str]:
+    return _EXT_LANG.get(os.path.splitext(path)[1].lower())
+
+
+def _build_instruction(task: TaskSpec) -> str:
+    title = task.title.strip()
+    description = task.description.strip()
+    return f"{title}\n\n{description}".strip()
+
+
+@functools.lru_cache(maxsize=4)
+def _build_repo_filename_index(repo_path: Path, commit: str) -> Dict[str, List[str]]:
+    """
+    Maps basename -> [repo-relative paths] for every file in `commit`.
+    Keyed on the commit id, so it is rebuilt only when the branch moved.
+    """
+    index: Dict[str, List[str]] = defaultdict(list)
+    for rel_path in list_files_at(repo_path, commit):
+        index[rel_path.rsplit("/", 1)[-1]].append(rel_path)
+    return dict(index)
+
+
+def resolve_repo_file(repo_path: Path, commit: str, rel_path: str) -> str:
+    """
+    Returns a repo-relative path that exists in `commit`. If `rel_path` does not
+    exist as given, it is resolved by filename: exactly one match is used, otherwise 400.
+    """
+    if rel_path in list_files_at(repo_path, commit):
+        return rel_path
+
+    filename = Path(rel_path).name
+    matches = _build_repo_filename_index(repo_path, commit).get(filename, [])
+    if len(matches) == 1:
+        return matches[0]
+    if not matches:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Target file does not exist in repo: {rel_path}",
+        )
+    raise HTTPException(
+        status_code=400,
+        detail=f"Multiple files named {filename} in repo: {', '.join(matches)}",
+    )
+
+
+def _resolve_target_files(repo_path: Path, commit: str, rel_paths: List[str]) -> List[str]:
+    """
+    Resolves every target file up front so a missing path fails the request
+    before any LLM call is made.
+    """
+    return [resolve_repo_file(repo_path, commit, rel_path) for rel_path in rel_paths]
+
+
+def _write_source_file(file_path: Path, content: str) -> None:
+    """
+    Encodes once, then raw open/write/close (no text-mode wrapper or buffer).
+    """
+    data = content.encode("utf-8")
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
+async def _apply_one_file(
+    repo_path: Path,
+    commit: str,
+    rel_path: str,
+    instruction: str,
+    language_hint: Optional[str],
+) -> Optional[Tuple[str, str]]:
+    """
+    Reads one target file as of `commit` and asks the coding agent for its new
+    content. Returns (rel_path, new_content), or None if the content is unchanged;
+    nothing is written until every file succeeded.
+    """
+    original_content = await asyncio.to_thread(read_file_at, repo_path, commit, rel_path)
+    async with _llm_semaphore:
+        try:
+            new_content = await agenerate_updated_file_content(
+                original_content=original_content,
+                file_path=rel_path,
+                instruction=instruction,
+                language_hint=language_hint or guess_language_from_extension(rel_path),
+            )
+        except PatchError as e:
+            # Only for files too large to rewrite whole (the agent edits those by diff only)
+            raise HTTPException(
+                status_code=500,
+                detail=f"Coding agent patch for {rel_path} did not apply: {e}",
+            )
+    if not isinstance(new_content, str) or not new_content.strip():
+        raise HTTPException(
+            status_code=500,
+            detail=f"Coding agent returned empty/invalid content for {rel_path}.",
+        )
+    # Only end-of-file whitespace differs (e.g. the trailing newline dropped by fence stripping)
+    if new_content.rstrip() == original_content.rstrip():
+        return None
+    return rel_path, new_content
+
+
+def _write_and_commit(
+    repo_path: Path,
+    branch_name: str,
+    commit: str,
+    updates: List[Tuple[str, str]],
+    commit_message: str,
+) -> bool:
+    """
+    Checks out the branch, writes the updated files and commits them, all under
+    repo_lock so no other request switches branches in between. Fails with 409
+    if the branch moved after its files were read at `commit`.
+    Returns commit_changes' result. Run it via asyncio.to_thread.
+    """
+    with repo_lock:
+        if ensure_branch_ref(repo_path, branch_name) != commit:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Branch {branch_name} changed while generating code; retry the request",
+            )
+        create_feature_branch(repo_path, branch_name)
+        for rel_path, new_content in updates:
+            _write_source_file(repo_path / rel_path, new_content)
+        return commit_changes(repo_path, commit_message, [rel_path for rel_path, _ in updates])
+
+
+def _checkout_and_test(repo_path: Path, branch_name: str) -> dict:
+    """
+    Checks out the branch and runs the tests on it under repo_lock, so the
+    working tree cannot switch branches mid-run. Run it via asyncio.to_thread.
+    """
+    with repo_lock:
+        try:
+            checkout_branch(repo_path, branch_name)
+        except RuntimeError as e:
+            raise HTTPException(status_code=400, detail=f"Cannot check out branch {branch_name}: {e}")
+        return run_tests_in_repo(repo_path)
 
 
 # -----------------------------------------------------------------------------
@@ -100,8 +313,8 @@ def health():
     return {"status": "ok"}
 
 
-@app.post("/tasks/from-message")
-def create_task_from_message(payload: MessageInput):
+@app.post("/tasks/from-message", response_model=TaskSpec)
+async def create_task_from_message(payload: MessageInput):
     """
     Creates a task using Spec Agent based on natural language input.
     Persists it in JSON storage.
@@ -110,34 +323,29 @@ def create_task_from_message(payload: MessageInput):
     if not raw_message:
         raise HTTPException(status_code=400, detail="message cannot be empty")
 
-    now_iso = _utc_now_iso()
+    now_iso = utc_now_iso()
 
-    task_spec_dict = generate_task_spec(raw_message)
-
-    # Ensure a few defaults
-    task_spec_dict.setdefault("status", "open")
-    task_spec_dict.setdefault("source", "CodePilot AI UI")
-    task_spec_dict.setdefault("timeline", [])
+    # Spec agent does git + LLM I/O; keep it off the event loop
+    task = await asyncio.to_thread(generate_task_spec, raw_message)
 
     # Add initial timeline event
-    task_spec_dict["timeline"].append(
+    task.timeline.append(
         {"at": now_iso, "event": "created", "details": f"Task created from message: {raw_message}"}
     )
 
-    save_task(task_spec_dict)
-    return task_spec_dict
+    await asyncio.to_thread(save_task, task)
+    return task
 
 
-@app.get("/tasks")
-def get_all_tasks():
+@app.get("/tasks", response_model=TaskList)
+def get_all_tasks(limit: Optional[int] = Query(default=None, ge=1)):
     """
-    List all tasks, newest first.
+    List all tasks, newest first (only the newest `limit` if given).
     """
-    tasks = list_tasks()
-    return {"tasks": tasks}
+    return {"tasks": list_tasks(limit)}
 
 
-@app.get("/tasks/{task_id}")
+@app.get("/tasks/{task_id}", response_model=TaskSpec)
 def get_task(task_id: str):
     """
     Fetch a single task by ID.
@@ -145,22 +353,33 @@ def get_task(task_id: str):
     return _get_task_or_404(task_id)
 
 
-@app.post("/tasks/{task_id}/apply-change")
-def apply_change_for_task(task_id: str, req: Optional[ApplyTaskCodeRequest] = None):
+@app.post(
+    "/tasks/{task_id}/apply-change",
+    response_model=ApplyChangeResult,
+    response_model_exclude_none=True,  # no push_status when nothing was committed
+)
+async def apply_change_for_task(
+    task_id: str,
+    background_tasks: BackgroundTasks,
+    req: Optional[ApplyTaskCodeRequest] = None,
+):
     """
     Apply AI-generated code changes for a task.
 
     Flow:
       1. Load task
       2. Ensure target repo is cloned
-      3. Create a feature branch
-      4. Pick target file from task['affected_files']
-      5. Generate updated content using Coding Agent
-      6. Write file
-      7. Commit & push
-      8. Update task timeline
+      3. Create the feature branch ref (not checked out)
+      4. Read (from the branch commit) + generate updated content for every file
+         in task.affected_files concurrently (one _apply_one_file per file)
+      5. Validate all results (unchanged files are skipped; none changed -> stop here)
+      6. Under repo_lock: check out the branch, write changed files, commit locally
+      7. Update task status/timeline and save once
+      8. Push in the background (poll GET /tasks/{task_id}/push-status)
+
+    Only step 6 uses the shared working tree; the LLM calls run without the lock.
     """
-    task = _get_task_or_404(task_id)
+    task = await asyncio.to_thread(_get_task_or_404, task_id)
 
     # Optional inputs
     language_hint = None
@@ -169,108 +388,115 @@ def apply_change_for_task(task_id: str, req: Optional[ApplyTaskCodeRequest] = No
         language_hint = req.language_hint
         branch_name_override = req.branch_name
 
-    repo_path: Path = ensure_repo_cloned()
-    add_task_event(task_id, "repo_ready", f"Repo ready at: {repo_path}")
+    repo_path: Path = await asyncio.to_thread(ensure_repo_cloned)
+    _append_event(task, "repo_ready", f"Repo ready at: {repo_path}")
 
     # Branch name
     branch_name = (branch_name_override or "").strip() or f"cpai-{task_id[:6]}"
 
-    # Create branch
-    create_feature_branch(repo_path, branch_name)
-    add_task_event(task_id, "branch_created", f"Branch created/checked out: {branch_name}")
-
-    # Decide which file to change
-    repo_relative_path = _pick_target_file_from_task(task)
-    file_path = repo_path / repo_relative_path
-
-    if not file_path.exists():
-        raise HTTPException(
-            status_code=400,
-            detail=f"Target file does not exist in repo: {repo_relative_path}",
-        )
-
-    original_content = file_path.read_text(encoding="utf-8", errors="ignore")
-
-    # Call coding agent to generate new content
-    new_content = generate_updated_file_content(
-        task=task,
-        file_relative_path=repo_relative_path,
-        original_content=original_content,
-        language_hint=language_hint,
+    # Create the branch; its files are read from this commit, not the working tree
+    commit = await asyncio.to_thread(ensure_branch_ref, repo_path, branch_name)
+    _append_event(task, "branch_created", f"Branch ready at {commit[:12]}: {branch_name}")
+
+    # Decide which files to change; a missing path fails before any LLM call
+    affected_files = _get_affected_files_from_task(task)
+    resolved = await asyncio.to_thread(_resolve_target_files, repo_path, commit, affected_files)
+
+    # Read + generate every file at once; wall time ~ slowest file, not the sum
+    instruction = _build_instruction(task)
+    results = await asyncio.gather(
+        *[
+            _apply_one_file(repo_path, commit, rel_path, instruction, language_hint)
+            for rel_path in resolved
+        ]
     )
 
-    if not isinstance(new_content, str) or not new_content.strip():
-        raise HTTPException(
-            status_code=500,
-            detail="Coding agent returned empty/invalid content.",
-        )
-
-    # Write updated file
-    file_path.write_text(new_content, encoding="utf-8")
-    add_task_event(task_id, "file_updated", f"Updated file: {repo_relative_path}")
+    # Files the agent left unchanged are not rewritten; nothing changed -> no commit
+    updates = [update for update in results if update is not None]
+    if not updates:
+        _append_event(task, "no_changes", "Coding agent returned unchanged content for all files")
+        await asyncio.to_thread(save_task, task)
+        return {
+            "status": "no_changes",
+            "task_id": task_id,
+            "branch": branch_name,
+            "updated_files": [],
+        }
 
-    # Commit and push
+    # Write + commit locally in one locked step; the network push runs after the response is sent
     commit_message = f"[CodePilot] Apply change for task {task_id}"
-    commit_and_push(repo_path, branch_name, commit_message)
-    add_task_event(task_id, "pushed", f"Committed & pushed changes on branch: {branch_name}")
-
-    # Update task metadata and timeline
-    now_iso = _utc_now_iso()
-    task["last_applied_branch"] = branch_name
-    task.setdefault("timeline", []).append(
-        {
-            "at": now_iso,
-            "event": "code_change_applied",
-            "details": f"Changes applied to {repo_relative_path} on branch {branch_name}",
-        }
+    committed = await asyncio.to_thread(
+        _write_and_commit, repo_path, branch_name, commit, updates, commit_message
     )
-    save_task(task)
+    updated_files = [rel_path for rel_path, _ in updates]
+    _append_event(task, "file_updated", f"Updated files: {', '.join(updated_files)}")
+    if committed:
+        _append_event(task, "committed", f"Committed changes on branch: {branch_name}")
+    else:
+        _append_event(task, "commit_skipped", f"Nothing staged on branch: {branch_name}")
+
+    # Update task metadata and timeline, then persist once
+    _finalize_apply(task, branch_name, updated_files)
+    task.push_status = "pending"
+    task.push_error = None
+    await asyncio.to_thread(save_task, task)
+
+    background_tasks.add_task(_push_and_record, repo_path, branch_name, task_id)
 
     return {
         "status": "success",
         "task_id": task_id,
         "branch": branch_name,
-        "updated_file": repo_relative_path,
+        "updated_files": updated_files,
+        "push_status": "pending",
     }
 
 
-@app.post("/tasks/{task_id}/run-tests")
-def run_tests_for_task(task_id: str, payload: RunTestsRequest):
+@app.get("/tasks/{task_id}/push-status", response_model=PushStatus)
+def get_push_status(task_id: str):
     """
-    Run tests on the target repo for a given branch.
+    Status of the background push started by apply-change:
+    "pending", "pushed" or "failed" (None if the task was never applied).
     """
     task = _get_task_or_404(task_id)
+    return {
+        "task_id": task_id,
+        "branch": task.last_applied_branch,
+        "push_status": task.push_status,
+        "push_error": task.push_error,
+    }
 
-    repo_path: Path = ensure_repo_cloned()
-    branch_name = payload.branch_name.strip()
-    if not branch_name:
-        raise HTTPException(status_code=400, detail="branch_name cannot be empty")
 
-    add_task_event(task_id, "tests_started", f"Running tests on branch: {branch_name}")
+@app.post("/tasks/{task_id}/run-tests", response_model=RunTestsResult)
+async def run_tests_for_task(task_id: str, payload: Optional[RunTestsRequest] = None):
+    """
+    Run tests on the target repo for a given branch
+    (defaults to the task's last applied branch).
+    """
+    task = await asyncio.to_thread(_get_task_or_404, task_id)
 
-    result = run_tests_in_repo(repo_path, branch_name)
+    requested_branch = payload.branch_name if payload else None
+    branch_name = (requested_branch or task.last_applied_branch or "").strip()
+    if not branch_name:
+        raise HTTPException(
+            status_code=400,
+            detail="branch_name is required (task has no applied branch yet)",
+        )
 
-    now_iso = _utc_now_iso()
-    task.setdefault("timeline", []).append(
-        {
-            "at": now_iso,
-            "event": "tests_run",
-            "details": f"Tests run on branch {branch_name} (exit_code={result.exit_code})",
-        }
-    )
-    save_task(task)
+    repo_path: Path = await asyncio.to_thread(ensure_repo_cloned)
+    _append_event(task, "tests_started", f"Running tests on branch: {branch_name}")
 
-    add_task_event(
-        task_id,
-        "tests_finished",
-        f"Tests completed (exit_code={result.exit_code}) on branch: {branch_name}",
-    )
+    result = await asyncio.to_thread(_checkout_and_test, repo_path, branch_name)
+    exit_code = result["exit_code"]
+
+    _append_event(task, "tests_finished", f"Tests completed (exit_code={exit_code}) on branch: {branch_name}")
+    await asyncio.to_thread(save_task, task)
 
     return {
-        "status": "passed" if result.exit_code == 0 else "failed",
+        "status": "passed" if exit_code == 0 else "failed",
         "task_id": task_id,
         "branch": branch_name,
-        "exit_code": result.exit_code,
-        "stdout_tail": result.stdout_tail,
-        "stderr_tail": result.stderr_tail,
+        "exit_code": exit_code,
+        "stdout_tail": result["stdout"],
+        "stderr_tail": result["stderr"],
     }
@@ -0,0 +1,59 @@
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+
+class HealthStatus(BaseModel):
+    status: str
+
+
+class MessageInput(BaseModel):
+    message: str
+
+
+class ApplyTaskCodeRequest(BaseModel):
+    """
+    Optional inputs for apply-change.
+    We keep this minimal and stable (AI infers file from task spec).
+    """
+    language_hint: Optional[str] = None
+    branch_name: Optional[str] = None
+
+
+class RunTestsRequest(BaseModel):
+    """
+    Defaults to the branch the task was last applied on.
+    """
+    branch_name: Optional[str] = None
+
+
+class TaskList(BaseModel):
+    """
+    Task summaries from the listing index (see task_storage._SUMMARY_FIELDS).
+    """
+    tasks: List[Dict[str, Any]]
+
+
+class ApplyChangeResult(BaseModel):
+    status: str
+    task_id: str
+    branch: str
+    updated_files: List[str]
+    # Only when a commit was made; omitted for "no_changes"
+    push_status: Optional[str] = None
+
+
+class PushStatus(BaseModel):
+    task_id: str
+    branch: Optional[str] = None
+    push_status: Optional[str] = None
+    push_error: Optional[str] = None
+
+
+class RunTestsResult(BaseModel):
+    status: str
+    task_id: str
+    branch: str
+    exit_code: int
+    stdout_tail: str
+    stderr_tail: str
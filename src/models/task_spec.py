@@ -1,17 +1,27 @@
-from typing import List
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
 from uuid import uuid4
 import os
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
+
+
+def utc_now_iso() -> str:
+    """
+    Current UTC time as ISO 8601, the format of created_at and timeline "at" values.
+    """
+    return datetime.now(timezone.utc).isoformat()
 
 
 class TaskSpec(BaseModel):
     """
-    Minimal Task specification model used by spec_agent to structure model output.
-    The rest of the system stores tasks as plain JSON/dicts, so this model is only
-    used at generation time.
+    A task as generated by spec_agent and persisted by task_storage.
+    Loaded once per request, mutated through attributes and saved once.
+    Unknown keys from older task files are kept (extra="allow").
     """
 
+    model_config = ConfigDict(extra="allow")
+
     task_id: str
     title: str
     description: str
@@ -19,13 +29,34 @@ class TaskSpec(BaseModel):
     target_branch: str
     affected_files: List[str] = Field(default_factory=list)
 
+    # Backend-managed lifecycle fields
+    status: str = "open"
+    created_at: Optional[str] = None
+    source: Optional[str] = None
+    timeline: List[Dict[str, Any]] = Field(default_factory=list)
+    run_history: List[Dict[str, Any]] = Field(default_factory=list)
+    last_applied_branch: Optional[str] = None
+    last_applied_at: Optional[str] = None
+    push_status: Optional[str] = None
+    push_error: Optional[str] = None
+
+    # Field values as last loaded/saved by task_storage (not serialized); save_task
+    # uses it to merge only this instance's changes into the file on disk.
+    _base: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+
     @staticmethod
     def create_default() -> "TaskSpec":
-        return TaskSpec(
-            task_id=str(uuid4()),
+        # Every value is produced here and already has the declared type, so skip
+        # validation; model_construct still fills the remaining defaults
+        return TaskSpec.model_construct(
+            task_id=uuid4().hex,
             title="",
             description="",
             target_repo=os.getenv("TARGET_REPO_URL", ""),
             target_branch=os.getenv("TARGET_REPO_BRANCH", "master"),
             affected_files=[],
         )
+
+
+# Finalize the validator at import time instead of on the first generated spec
+TaskSpec.model_rebuild()
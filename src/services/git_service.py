@@ -1,92 +1,468 @@
+import functools
+import logging
+import shlex
 import subprocess
+import threading
+import time
 from pathlib import Path
-from typing import Optional, List
+from typing import FrozenSet, NamedTuple, Optional, List, Tuple
 import os
 
+logger = logging.getLogger(__name__)
+
+
+def _debug_command(cmd: List[str], cwd: Optional[str]) -> None:
+    logger.debug("git: %s (cwd=%s)", " ".join(cmd), cwd)
+
+
+def _debug_output(p: subprocess.CompletedProcess) -> None:
+    logger.debug("stdout: %s", (p.stdout or "").strip())
+    logger.debug("stderr: %s", (p.stderr or "").strip())
+
+
+def _raise_if_failed(p: subprocess.CompletedProcess, cmd: List[str], cwd: Optional[str], allow_fail: bool) -> None:
+    if p.returncode != 0 and not allow_fail:
+        raise RuntimeError(
+            f"Git command failed: {' '.join(cmd)}\n"
+            f"cwd={cwd}\n"
+            f"stdout={p.stdout}\n"
+            f"stderr={p.stderr}"
+        )
+
 
 def run_git_command(
     cmd: List[str],
     cwd: Optional[str] = None,
     allow_fail: bool = False,
+    discard_stdout: bool = False,
+    input: Optional[str] = None,
 ) -> subprocess.CompletedProcess:
     """
-    Runs a git command with pretty logs.
+    Runs a git command (logged at DEBUG with its output when GIT_DEBUG is set).
     If allow_fail=True, it won't raise even if command fails.
+    discard_stdout=True sends stdout to /dev/null for commands whose output is
+    unused; stderr is always captured for the error message.
+    `input` is written to the command's stdin (e.g. --pathspec-from-file=-).
     """
-    print(f"▶ {' '.join(cmd)} (cwd={cwd})")
-    p = subprocess.run(cmd, cwd=cwd, text=True, capture_output=True)
+    git_debug = _cfg().git_debug
+    if git_debug:
+        _debug_command(cmd, cwd)
+    p = subprocess.run(
+        cmd,
+        cwd=cwd,
+        input=input,
+        text=True,
+        stdout=subprocess.DEVNULL if discard_stdout else subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if git_debug:
+        _debug_output(p)
+    _raise_if_failed(p, cmd, cwd, allow_fail)
+    return p
 
-    if p.stdout:
-        print("stdout:", p.stdout.strip())
-    else:
-        print("stdout:")
 
-    if p.stderr:
-        print("stderr:", p.stderr.strip())
-    else:
-        print("stderr:")
+def run_git_script(
+    script: str,
+    cwd: Optional[str] = None,
+    allow_fail: bool = False,
+    discard_stdout: bool = False,
+) -> subprocess.CompletedProcess:
+    """
+    Runs several git commands as one `/bin/sh -c` script (one process spawn
+    instead of one per command). Join steps with && / ||; shlex.quote every
+    interpolated value. Same logging and error behaviour as `run_git_command`.
+    """
+    return run_git_command(
+        ["/bin/sh", "-c", script], cwd=cwd, allow_fail=allow_fail, discard_stdout=discard_stdout
+    )
 
-    if p.returncode != 0 and not allow_fail:
-        raise RuntimeError(
-            f"Git command failed: {' '.join(cmd)}\n"
-            f"cwd={cwd}\n"
-            f"stdout={p.stdout}\n"
-            f"stderr={p.stderr}"
+
+@functools.lru_cache(maxsize=8)
+def _git(repo_path: Path) -> Tuple[str, ...]:
+    """
+    argv prefix `git -C <repo_path>`, built once per repo path, so commands
+    need no per-call cwd= / str(repo_path).
+    """
+    return ("git", "-C", str(repo_path))
+
+
+def git_index_mtime_ns(repo_path: Path) -> int:
+    """
+    mtime of .git/index. Git rewrites the index on checkout/commit/pull/add,
+    so this is a cheap (single stat) version stamp for the tracked tree.
+    """
+    try:
+        return (repo_path / ".git" / "index").stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+# Bumped by helpers below that change tracked content without switching branch
+# (commit, pull/clone). Part of the tracked-tree version, so cached listings are
+# dropped even when the filesystem's mtime granularity hides an index rewrite.
+_tree_generation = 0
+
+
+def _invalidate_tracked_tree() -> None:
+    global _tree_generation
+    _tree_generation += 1
+
+
+def tracked_tree_version(repo_path: Path) -> Tuple[int, bytes, int]:
+    """
+    Cheap version stamp of the tracked tree: (.git/index mtime, .git/HEAD contents,
+    local generation). A stat and a tiny read, no subprocess. Use as a cache key
+    for anything derived from `git ls-files`.
+    """
+    try:
+        head = (repo_path / ".git" / "HEAD").read_bytes()
+    except FileNotFoundError:
+        head = b""
+    return git_index_mtime_ns(repo_path), head, _tree_generation
+
+
+def current_branch(repo_path: Path) -> Optional[str]:
+    """
+    Name of the checked-out branch, read straight from .git/HEAD (no subprocess).
+    None for a detached HEAD or a missing repo.
+    """
+    try:
+        head = (repo_path / ".git" / "HEAD").read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+    prefix = "ref: refs/heads/"
+    return head[len(prefix):] if head.startswith(prefix) else None
+
+
+def _checkout(repo_path: Path, branch_name: str) -> None:
+    # Checking out the branch that is already checked out is a no-op; skip the fork/exec
+    if current_branch(repo_path) == branch_name:
+        return
+    run_git_command([*_git(repo_path), "checkout", branch_name], allow_fail=False, discard_stdout=True)
+
+
+@functools.lru_cache(maxsize=4)
+def _ls_files(repo_path: Path, version: Tuple[int, bytes, int]) -> Tuple[str, ...]:
+    # -z: NUL-separated, unquoted paths (otherwise git C-quotes non-ASCII/special names)
+    p = run_git_command([*_git(repo_path), "ls-files", "-z"], allow_fail=False)
+    return tuple(path for path in p.stdout.split("\0") if path)
+
+
+@functools.lru_cache(maxsize=4)
+def _ls_files_set(repo_path: Path, version: Tuple[int, bytes, int]) -> FrozenSet[str]:
+    return frozenset(_ls_files(repo_path, version))
+
+
+def list_tracked_files(repo_path: Path) -> Tuple[str, ...]:
+    """
+    Returns tracked file paths (`git ls-files -z`). The result is memoized per
+    tracked-tree version, so git is only spawned when the tree may have changed.
+    """
+    return _ls_files(repo_path, tracked_tree_version(repo_path))
+
+
+def tracked_file_set(repo_path: Path) -> FrozenSet[str]:
+    """
+    Same snapshot as `list_tracked_files`, as a frozenset for O(1) membership checks.
+    Built once per index version and shared across requests.
+    """
+    return _ls_files_set(repo_path, tracked_tree_version(repo_path))
+
+
+class _RepoConfig(NamedTuple):
+    repo_url: Optional[str]
+    repo_path: Optional[Path]
+    base_branch: str
+    # Optional bare-mirror cache (e.g. ./workspace/.mirrors). When set, workspace clones
+    # borrow objects from a shared mirror via --reference instead of downloading them again.
+    mirror_dir: Optional[str]
+    # Workspace clones only need the tip of the base branch: clone/fetch with this
+    # history depth (0 = full history). Applies to mirror-backed clones too.
+    clone_depth: int
+    # Skip the network sync (fetch/pull) if this process synced the repo more recently than this
+    sync_ttl_seconds: int
+    # GIT_DEBUG=1 logs every git command and its output at DEBUG (to stderr
+    # when the app has not configured logging)
+    git_debug: bool
+
+
+@functools.lru_cache(maxsize=1)
+def _cfg() -> _RepoConfig:
+    """
+    Target-repo and git settings, read from the environment once, on first use (so after
+    openai_client has loaded .env, whatever the import order).
+    """
+    repo_path = os.getenv("TARGET_REPO_LOCAL_PATH")
+    git_debug = bool(os.getenv("GIT_DEBUG"))
+    if git_debug:
+        logger.setLevel(logging.DEBUG)
+        if not logging.getLogger().handlers:
+            # The app configures no logging, so DEBUG records would be dropped
+            logger.addHandler(logging.StreamHandler())
+    return _RepoConfig(
+        repo_url=os.getenv("TARGET_REPO_URL"),
+        repo_path=Path(repo_path) if repo_path else None,
+        base_branch=os.getenv("TARGET_REPO_BRANCH", "master"),
+        mirror_dir=os.getenv("CPAI_MIRROR_DIR"),
+        clone_depth=int(os.getenv("REPO_CLONE_DEPTH", "1")),
+        sync_ttl_seconds=int(os.getenv("REPO_SYNC_TTL_SECONDS", "60")),
+        git_debug=git_debug,
+    )
+
+
+def _ensure_mirror(repo_url: str) -> Path:
+    """
+    Creates or refreshes the bare mirror for `repo_url` under CPAI_MIRROR_DIR.
+    """
+    name = repo_url.rstrip("/").rsplit("/", 1)[-1]
+    if name.endswith(".git"):
+        name = name[:-4]
+    mirror_path = Path(_cfg().mirror_dir) / f"{name}.git"
+
+    if not mirror_path.exists():
+        mirror_path.parent.mkdir(parents=True, exist_ok=True)
+        run_git_command(["git", "clone", "--mirror", repo_url, str(mirror_path)], cwd=None, discard_stdout=True)
+    else:
+        run_git_command(
+            [*_git(mirror_path), "remote", "update", "--prune"], allow_fail=False, discard_stdout=True
         )
-    return p
+    return mirror_path
+
 
+# The working tree is shared by every request: hold this across anything that
+# depends on, or changes, what is checked out (sync, checkout + write + commit,
+# checkout + test run). Reentrant, so a holder can call ensure_repo_cloned.
+repo_lock = threading.RLock()
+_last_synced_at: Optional[float] = None
 
-def ensure_repo_cloned() -> Path:
+
+def ensure_repo_cloned(force: bool = False) -> Path:
     """
-    Ensures repo exists locally. Clones if not present, otherwise pulls latest.
-    Uses TARGET_REPO_URL and TARGET_REPO_LOCAL_PATH from env.
+    Ensures repo exists locally. Clones if not present, otherwise fetches and
+    resets the base branch to the remote tip (skipped when already there).
+    Uses TARGET_REPO_URL, TARGET_REPO_LOCAL_PATH and TARGET_REPO_BRANCH from env.
+
+    Within REPO_SYNC_TTL_SECONDS of the last sync only the base branch checkout
+    runs (so new feature branches still start from it); pass force=True to
+    always fetch.
     """
-    repo_url = os.getenv("TARGET_REPO_URL")
-    repo_path_str = os.getenv("TARGET_REPO_LOCAL_PATH")
+    with repo_lock:
+        return _ensure_repo_cloned_locked(force)
 
-    if not repo_url or not repo_path_str:
+
+def _ensure_repo_cloned_locked(force: bool) -> Path:
+    global _last_synced_at
+
+    cfg = _cfg()
+    repo_url = cfg.repo_url
+    repo_path = cfg.repo_path
+    base_branch = cfg.base_branch
+
+    if not repo_url or repo_path is None:
         raise RuntimeError("TARGET_REPO_URL / TARGET_REPO_LOCAL_PATH not set")
 
-    repo_path = Path(repo_path_str)
+    recently_synced = (
+        _last_synced_at is not None
+        and time.monotonic() - _last_synced_at < cfg.sync_ttl_seconds
+    )
+    repo_exists = repo_path.exists()
+    if not force and recently_synced and repo_exists:
+        _checkout(repo_path, base_branch)
+        return repo_path
+
+    br = shlex.quote(base_branch)
+    depth = cfg.clone_depth
+    shallow = ["--depth", str(depth), "--single-branch"] if depth > 0 else []
 
-    if not repo_path.exists():
-        print("📥 Cloning repo for the first time...")
+    if not repo_exists:
+        logger.debug("Cloning repo for the first time: %s", repo_path)
         repo_path.parent.mkdir(parents=True, exist_ok=True)
-        run_git_command(["git", "clone", repo_url, str(repo_path)], cwd=None)
+        clone = ["git", "clone", *shallow, "--branch", base_branch]
+        if cfg.mirror_dir:
+            mirror_path = _ensure_mirror(repo_url)
+            clone += ["--reference", str(mirror_path)]
+        try:
+            # --branch leaves the base branch checked out at the tip; nothing to pull
+            run_git_command([*clone, repo_url, str(repo_path)], cwd=None, discard_stdout=True)
+        finally:
+            _invalidate_tracked_tree()
     else:
-        print("📁 Repo already cloned, pulling latest changes...")
-        run_git_command(["git", "fetch", "origin"], cwd=str(repo_path), allow_fail=False)
-
-    # Ensure base branch exists and pull
-    base_branch = "master"  # you can make configurable later
-    run_git_command(["git", "checkout", base_branch], cwd=str(repo_path), allow_fail=False)
-    run_git_command(["git", "pull", "origin", base_branch], cwd=str(repo_path), allow_fail=False)
+        logger.debug("Repo already cloned, pulling latest changes: %s", repo_path)
+        if depth > 0:
+            # Shallow: fetch just the new tip (no history to merge)
+            fetch, tip = f"git fetch --depth {depth} origin {br}", "FETCH_HEAD"
+        else:
+            fetch, tip = "git fetch origin", shlex.quote(f"refs/remotes/origin/{base_branch}")
+        # Move the branch to the fetched tip with reset --hard (no merge), and only
+        # when it actually changed; an up-to-date repo skips the working-tree update
+        script = (
+            f"{fetch} && git checkout {br} && "
+            f'{{ [ "$(git rev-parse HEAD)" = "$(git rev-parse {tip})" ] || git reset --hard {tip}; }}'
+        )
+        try:
+            run_git_script(script, cwd=str(repo_path), allow_fail=False, discard_stdout=True)
+        finally:
+            _invalidate_tracked_tree()
 
+    _last_synced_at = time.monotonic()
     return repo_path
 
 
+def _fetch_branch_script(branch_name: str) -> str:
+    """
+    Shell snippet that fetches origin's `branch_name` and creates it locally at the
+    fetched tip. Needed because --single-branch clones only track the base branch,
+    so `git checkout <branch>` cannot find an existing origin/<branch> by itself.
+    """
+    br = shlex.quote(branch_name)
+    depth = _cfg().clone_depth
+    shallow = f"--depth {depth} " if depth > 0 else ""
+    return f"{{ git fetch {shallow}origin {br} && git checkout -b {br} FETCH_HEAD; }}"
+
+
+def ensure_branch_ref(repo_path: Path, branch_name: str) -> str:
+    """
+    Makes sure a local `branch_name` exists, without checking it out: the local
+    branch, else origin's (fetched), else a new branch at the base branch tip.
+    Returns the branch's commit id, so its files can be read with `read_file_at`
+    while other requests use the working tree.
+    """
+    branch_name = branch_name.strip()
+    if not branch_name:
+        raise ValueError("branch_name cannot be empty")
+
+    ref = shlex.quote(f"refs/heads/{branch_name}")
+    depth = _cfg().clone_depth
+    shallow = f"--depth {depth} " if depth > 0 else ""
+    # One spawn: create the ref if needed, then print its commit id
+    script = (
+        f"{{ git rev-parse -q --verify {ref} || "
+        f"git fetch {shallow}origin {shlex.quote(f'{branch_name}:refs/heads/{branch_name}')} || "
+        f"git branch {shlex.quote(branch_name)} {shlex.quote(_cfg().base_branch)}; }} >/dev/null && "
+        f"git rev-parse --verify {ref}"
+    )
+    with repo_lock:
+        p = run_git_script(script, cwd=str(repo_path), allow_fail=False)
+    return p.stdout.strip()
+
+
+@functools.lru_cache(maxsize=4)
+def list_files_at(repo_path: Path, commit: str) -> Tuple[str, ...]:
+    """
+    File paths in `commit`'s tree (`git ls-tree -r -z`). Memoized per commit id,
+    which never changes content.
+    """
+    p = run_git_command([*_git(repo_path), "ls-tree", "-r", "-z", "--name-only", commit])
+    return tuple(path for path in p.stdout.split("\0") if path)
+
+
+def read_file_at(repo_path: Path, commit: str, rel_path: str) -> str:
+    """
+    Contents of `rel_path` in `commit`, read from the object store (the working
+    tree and the checked-out branch are not touched).
+    """
+    p = subprocess.run(
+        [*_git(repo_path), "cat-file", "blob", f"{commit}:{rel_path}"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if p.returncode != 0:
+        raise RuntimeError(f"Cannot read {rel_path} at {commit}: {p.stderr.decode('utf-8', errors='replace')}")
+    return p.stdout.decode("utf-8", errors="ignore")
+
+
 def create_feature_branch(repo_path: Path, branch_name: str) -> None:
     """
-    Creates or checks out a feature branch inside the repo.
+    Creates or checks out a feature branch inside the repo: the local branch if
+    it exists, else origin's (so a re-applied task continues the pushed branch),
+    else a new branch from current HEAD.
     """
     branch_name = branch_name.strip()
     if not branch_name:
         raise ValueError("branch_name cannot be empty")
 
-    # If branch exists locally, checkout works
-    p = run_git_command(["git", "checkout", branch_name], cwd=str(repo_path), allow_fail=True)
-    if p.returncode == 0:
+    if current_branch(repo_path) == branch_name:
         return
 
-    # Otherwise create a new branch from current HEAD
-    run_git_command(["git", "checkout", "-b", branch_name], cwd=str(repo_path), allow_fail=False)
+    br = shlex.quote(branch_name)
+    run_git_script(
+        f"git checkout {br} || {_fetch_branch_script(branch_name)} || git checkout -b {br}",
+        cwd=str(repo_path),
+        allow_fail=False,
+        discard_stdout=True,
+    )
+
+
+def checkout_branch(repo_path: Path, branch_name: str) -> None:
+    """
+    Checks out an existing branch (local, or fetched from origin on demand).
+    """
+    branch_name = branch_name.strip()
+    if not branch_name:
+        raise ValueError("branch_name cannot be empty")
+    if current_branch(repo_path) == branch_name:
+        return
+    br = shlex.quote(branch_name)
+    run_git_script(
+        f"git checkout {br} || {_fetch_branch_script(branch_name)}",
+        cwd=str(repo_path),
+        allow_fail=False,
+        discard_stdout=True,
+    )
+
+
+def commit_changes(repo_path: Path, commit_message: str, paths: Optional[List[str]] = None) -> bool:
+    """
+    Stages and commits changes (local only, no network). With `paths`, only
+    those repo-relative files are staged instead of scanning the whole tree
+    with `git add .`; they are streamed NUL-separated over stdin, so any number
+    of paths is one `git add` with a short argv.
+    Returns False without committing when nothing ended up staged.
+    """
+    try:
+        if paths:
+            run_git_command(
+                [*_git(repo_path), "add", "--pathspec-from-file=-", "--pathspec-file-nul"],
+                discard_stdout=True,
+                input="\0".join(paths),
+            )
+        else:
+            run_git_command([*_git(repo_path), "add", "."], discard_stdout=True)
+
+        # Exit code 0: index matches HEAD, 1: staged changes, anything else: error
+        p = run_git_command(
+            [*_git(repo_path), "diff", "--cached", "--quiet"], allow_fail=True, discard_stdout=True
+        )
+        if p.returncode == 0:
+            return False
+        if p.returncode != 1:
+            _raise_if_failed(p, p.args, None, allow_fail=False)
+
+        run_git_command(
+            [*_git(repo_path), "commit", "-m", commit_message], allow_fail=False, discard_stdout=True
+        )
+        return True
+    finally:
+        _invalidate_tracked_tree()
+
+
+def push_branch(repo_path: Path, branch_name: str) -> None:
+    """
+    Pushes the branch to origin and sets upstream.
+    """
+    run_git_command(
+        [*_git(repo_path), "push", "-u", "origin", branch_name], allow_fail=False, discard_stdout=True
+    )
 
 
-def commit_and_push(repo_path: Path, branch_name: str, commit_message: str) -> None:
+def commit_and_push(
+    repo_path: Path,
+    branch_name: str,
+    commit_message: str,
+    paths: Optional[List[str]] = None,
+) -> None:
     """
-    Commits changes and pushes the branch.
+    Commits changes (only `paths`, if given) and pushes the branch.
     """
-    run_git_command(["git", "status"], cwd=str(repo_path))
-    run_git_command(["git", "add", "."], cwd=str(repo_path))
-    run_git_command(["git", "commit", "-m", commit_message], cwd=str(repo_path), allow_fail=False)
-    run_git_command(["git", "push", "-u", "origin", branch_name], cwd=str(repo_path), allow_fail=False)
+    commit_changes(repo_path, commit_message, paths)
+    push_branch(repo_path, branch_name)
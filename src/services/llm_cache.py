@@ -0,0 +1,148 @@
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, NamedTuple, Optional
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+class _CacheConfig(NamedTuple):
+    cache_dir: Path
+    # Entries older than this are treated as misses. Set to 0 to disable the cache.
+    ttl_seconds: int
+    # Total size cap; least recently used entries (by file mtime) are evicted past it
+    max_bytes: int
+
+
+@functools.lru_cache(maxsize=1)
+def _cfg() -> _CacheConfig:
+    """
+    LLM_CACHE_DIR / LLM_CACHE_TTL_SECONDS / LLM_CACHE_MAX_BYTES, read from the
+    environment once, on first use (so after openai_client has loaded .env,
+    whatever the import order).
+    """
+    return _CacheConfig(
+        cache_dir=Path(os.getenv("LLM_CACHE_DIR", ".cache/llm")),
+        ttl_seconds=int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+        max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(1024 ** 3))),
+    )
+
+
+# Eviction scans the whole cache dir, so only run it every N writes, on a
+# background thread (never inline in the request that happened to be the Nth)
+_PRUNE_EVERY = 100
+_writes_since_prune = 0
+_pruning = False
+_prune_lock = threading.Lock()
+
+
+def make_key(*parts: Any) -> str:
+    """
+    Build a deterministic cache key from the full prompt tuple
+    (system prompt, user prompt, model, temperature, ...).
+    """
+    canonical = orjson.dumps(parts, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(canonical, digest_size=32).hexdigest()
+
+
+def _path_for(key: str) -> Path:
+    # Shard by the first two hex chars so a single directory never gets huge
+    return _cfg().cache_dir / key[:2] / f"{key}.json"
+
+
+def cache_get(key: str) -> Optional[str]:
+    """
+    Return the cached model output for `key`, or None on miss / expiry.
+    """
+    ttl_seconds = _cfg().ttl_seconds
+    if ttl_seconds <= 0:
+        return None
+
+    path = _path_for(key)
+    try:
+        entry = orjson.loads(path.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return None
+
+    if time.time() - entry.get("stored_at", 0) > ttl_seconds:
+        path.unlink(missing_ok=True)
+        return None
+
+    # Mark as recently used for LRU eviction (TTL uses stored_at, not mtime)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return entry.get("value")
+
+
+def cache_set(key: str, value: str) -> None:
+    """
+    Store a model output under `key`. Written to a temp file and renamed so
+    concurrent readers never see a partial entry.
+    """
+    if _cfg().ttl_seconds <= 0:
+        return
+
+    path = _path_for(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Unique per process and thread: two identical concurrent requests both write
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(orjson.dumps({"stored_at": time.time(), "value": value}))
+    os.replace(tmp, path)
+
+    global _writes_since_prune, _pruning
+    with _prune_lock:
+        _writes_since_prune += 1
+        if _writes_since_prune < _PRUNE_EVERY or _pruning:
+            return
+        _writes_since_prune = 0
+        _pruning = True
+    threading.Thread(target=_prune_in_background, name="llm-cache-prune", daemon=True).start()
+
+
+def _prune_in_background() -> None:
+    global _pruning
+    try:
+        _prune()
+    except OSError:
+        logger.warning("LLM cache eviction failed", exc_info=True)
+    finally:
+        with _prune_lock:
+            _pruning = False
+
+
+def _prune() -> None:
+    """
+    Evict least recently used entries until the cache is below 90% of LLM_CACHE_MAX_BYTES.
+    """
+    cfg = _cfg()
+    entries = []
+    total = 0
+    for shard in cfg.cache_dir.iterdir():
+        if not shard.is_dir():
+            continue
+        for path in shard.glob("*.json"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+    if total <= cfg.max_bytes:
+        return
+
+    target = cfg.max_bytes * 9 // 10
+    entries.sort()
+    for _, size, path in entries:
+        if total <= target:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
@@ -0,0 +1,90 @@
+import logging
+import os
+from typing import Any, Dict
+
+import httpx
+import orjson
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from src.services import llm_cache
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# One pool per client, sized above the apply-change fan-out so concurrent calls
+# reuse keep-alive TCP/TLS connections instead of handshaking per request.
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=32)
+
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=DefaultHttpxClient(limits=_HTTP_LIMITS),
+)
+async_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=DefaultAsyncHttpxClient(limits=_HTTP_LIMITS),
+)
+
+
+def collect_stream(response: Any) -> str:
+    """
+    Accumulates a `stream=True` chat completion into the full message text.
+    """
+    parts = []
+    for chunk in response:
+        if chunk.choices:
+            parts.append(chunk.choices[0].delta.content or "")
+    return "".join(parts)
+
+
+async def acollect_stream(response: Any) -> str:
+    """
+    Async counterpart of `collect_stream` for AsyncOpenAI streams.
+    """
+    parts = []
+    async for chunk in response:
+        if chunk.choices:
+            parts.append(chunk.choices[0].delta.content or "")
+    return "".join(parts)
+
+
+def chat_completion_json(
+    system_prompt: str,
+    user_payload: Any,
+    model: str = "gpt-4o",
+    temperature: float = 0.2,
+) -> Dict[str, Any]:
+    """
+    Calls the chat completion API in JSON mode and returns the parsed object.
+    The system prompt must mention JSON (required by the API for json_object).
+    Identical prompts are served from the on-disk LLM cache.
+    """
+    user_content = (
+        user_payload if isinstance(user_payload, str) else orjson.dumps(user_payload).decode("utf-8")
+    )
+
+    key = llm_cache.make_key(system_prompt, user_content, model, temperature, "json_object")
+    content = llm_cache.cache_get(key)
+    from_cache = content is not None
+
+    if not from_cache:
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content},
+            ],
+            temperature=temperature,
+            response_format={"type": "json_object"},
+            stream=True,
+        )
+        content = collect_stream(response)
+        logger.debug("RAW MODEL OUTPUT (%s):\n%s", model, content)
+
+    # JSON mode guarantees a syntactically valid object; no fence/prose stripping needed
+    data = orjson.loads(content)
+
+    # Only cache outputs that actually parsed
+    if not from_cache:
+        llm_cache.cache_set(key, content)
+    return data
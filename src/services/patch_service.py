@@ -0,0 +1,95 @@
+import re
+from typing import List, Optional, Tuple
+
+_HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@")
+
+
+class PatchError(ValueError):
+    """
+    Raised when a model-produced patch cannot be parsed or does not apply.
+    """
+
+
+def _parse_hunks(patch: str) -> List[Tuple[int, List[str], List[str]]]:
+    """
+    Parse a unified diff into [(old_start, old_lines, new_lines), ...].
+    File headers (---/+++/diff/index) are ignored; only one file is expected.
+    """
+    hunks: List[Tuple[int, List[str], List[str]]] = []
+    current: Optional[Tuple[int, List[str], List[str]]] = None
+
+    for line in patch.splitlines():
+        header = _HUNK_HEADER_RE.match(line)
+        if header:
+            current = (int(header.group(1)), [], [])
+            hunks.append(current)
+            continue
+        if current is None or line.startswith("\\"):
+            # Preamble / file headers, or "\ No newline at end of file"
+            continue
+
+        _, old_lines, new_lines = current
+        op, text = (line[0], line[1:]) if line else (" ", "")
+        if op == " ":
+            old_lines.append(text)
+            new_lines.append(text)
+        elif op == "-":
+            old_lines.append(text)
+        elif op == "+":
+            new_lines.append(text)
+        else:
+            # Anything else ends the hunk body (e.g. a header for another file)
+            current = None
+
+    if not hunks:
+        raise PatchError("Patch contains no hunks")
+    return hunks
+
+
+def _find_block(src: List[str], block: List[str], start: int, expected: int) -> int:
+    """
+    Find `block` in `src` at or after `start`, preferring the position nearest to
+    the hunk header's line number. Both are expected right-stripped already, so
+    trailing whitespace is ignored without re-stripping each candidate window.
+    """
+    last = len(src) - len(block)
+    expected = min(max(expected, start), max(last, start))
+    first = block[0] if block else None
+
+    for offset in range(0, len(src) + 1):
+        for idx in (expected - offset, expected + offset):
+            # Cheap first-line check before comparing the whole window
+            if start <= idx <= last and src[idx] == first and src[idx : idx + len(block)] == block:
+                return idx
+        if expected - offset < start and expected + offset > last:
+            break
+    raise PatchError(f"Hunk context not found near line {expected + 1}")
+
+
+def apply_unified_diff(original: str, patch: str) -> str:
+    """
+    Apply a single-file unified diff to `original` and return the new content.
+    Hunks are located by their context, so small line-number drift is tolerated.
+    """
+    newline = "\r\n" if "\r\n" in original else "\n"
+    src = original.splitlines()
+    # Stripped once for matching; output is still built from the original lines
+    src_stripped = [line.rstrip() for line in src]
+    out: List[str] = []
+    pos = 0
+
+    for old_start, old_lines, new_lines in _parse_hunks(patch):
+        if old_lines:
+            idx = _find_block(src_stripped, [line.rstrip() for line in old_lines], pos, old_start - 1)
+        else:
+            # Pure insertion: old_start is the line *after which* to insert
+            idx = min(max(old_start, pos), len(src))
+        out.extend(src[pos:idx])
+        out.extend(new_lines)
+        pos = idx + len(old_lines)
+
+    out.extend(src[pos:])
+    result = newline.join(out)
+    if original.endswith(("\n", "\r\n")):
+        result += newline
+    return result
@@ -0,0 +1,169 @@
+import copy
+import logging
+import math
+import operator
+import os
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+
+from src.services.openai_client import client
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Shortened embeddings (the model supports `dimensions`): a lookup scores every
+# entry in pure Python, so it costs O(MAX_ENTRIES * EMBEDDING_DIMENSIONS)
+EMBEDDING_DIMENSIONS = 512
+ENTRIES_PATH = Path(os.getenv("SPEC_CACHE_PATH", ".cache/spec_entries.jsonl"))
+SIMILARITY_THRESHOLD = float(os.getenv("SPEC_CACHE_SIMILARITY", "0.95"))
+ENTRY_TTL_SECONDS = 30 * 24 * 3600
+# Only the newest entries are kept (~5 ms per lookup at the default)
+MAX_ENTRIES = int(os.getenv("SPEC_CACHE_MAX_ENTRIES", "256"))
+
+_lock = threading.Lock()
+# Embeddings are held as array("f") (4 bytes per value instead of a float object)
+_entries: Optional[List[Dict[str, Any]]] = None
+# Lines in ENTRIES_PATH; the file is compacted to the in-memory entries past 2 * MAX_ENTRIES
+_file_lines = 0
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _embed(text: str) -> array:
+    """
+    Embed a message and L2-normalize it, so cosine similarity is a plain dot product.
+    """
+    response = client.embeddings.create(
+        model=EMBEDDING_MODEL, input=text, dimensions=EMBEDDING_DIMENSIONS
+    )
+    vec = response.data[0].embedding
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return array("f", [x / norm for x in vec])
+
+
+def _dump_line(entry: Dict[str, Any]) -> bytes:
+    return orjson.dumps({**entry, "embedding": entry["embedding"].tolist()}) + b"\n"
+
+
+def _compact(entries: List[Dict[str, Any]]) -> None:
+    """
+    Rewrite ENTRIES_PATH with just `entries`. Caller must hold _lock.
+    """
+    global _file_lines
+    tmp = ENTRIES_PATH.with_suffix(".tmp")
+    tmp.write_bytes(b"".join(_dump_line(entry) for entry in entries))
+    os.replace(tmp, ENTRIES_PATH)
+    _file_lines = len(entries)
+
+
+def _load_entries() -> List[Dict[str, Any]]:
+    """
+    Load cached entries once per process: the newest MAX_ENTRIES within their TTL
+    and of the current EMBEDDING_DIMENSIONS. Caller must hold _lock.
+    """
+    global _entries, _file_lines
+    if _entries is not None:
+        return _entries
+
+    entries: List[Dict[str, Any]] = []
+    lines = 0
+    cutoff = time.time() - ENTRY_TTL_SECONDS
+    try:
+        f = ENTRIES_PATH.open("rb")
+    except FileNotFoundError:
+        f = None
+    if f is not None:
+        with f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue
+                if entry.get("created_at", 0) < cutoff:
+                    continue
+                if len(entry.get("embedding") or ()) != EMBEDDING_DIMENSIONS:
+                    # Written before the embedding size changed; not comparable
+                    continue
+                entry["embedding"] = array("f", entry["embedding"])
+                entries.append(entry)
+
+    # The file is append-only, so the newest entries are at the end
+    entries = entries[-MAX_ENTRIES:]
+    _file_lines = lines
+    if len(entries) < lines:
+        # Compact the file so evicted entries are not re-read next start
+        _compact(entries)
+
+    _entries = entries
+    return entries
+
+
+def lookup(message: str) -> Tuple[Optional[Dict[str, Any]], Optional[array]]:
+    """
+    Find a previously generated spec for a semantically equivalent message.
+
+    Returns (spec, embedding). `spec` is None on a miss; `embedding` is returned
+    either way so the caller can pass it to `store` without re-embedding.
+    Embedding failures are treated as a miss so spec generation never breaks.
+    """
+    try:
+        vec = _embed(_normalize_text(message))
+    except Exception as e:
+        logger.warning("Semantic cache unavailable, skipping lookup: %r", e)
+        return None, None
+
+    # Score on a snapshot, outside the lock (store only appends or swaps the list)
+    with _lock:
+        entries = list(_load_entries())
+
+    cutoff = time.time() - ENTRY_TTL_SECONDS
+    best_score = -1.0
+    best_spec: Optional[Dict[str, Any]] = None
+    for entry in entries:
+        if entry["created_at"] < cutoff:
+            continue
+        score = sum(map(operator.mul, vec, entry["embedding"]))
+        if score > best_score:
+            best_score, best_spec = score, entry["spec"]
+
+    if best_spec is not None and best_score > SIMILARITY_THRESHOLD:
+        return copy.deepcopy(best_spec), vec
+    return None, vec
+
+
+def store(message: str, embedding: Optional[array], spec: Dict[str, Any]) -> None:
+    """
+    Remember the spec generated for `message`. No-op when embedding failed.
+    """
+    global _entries, _file_lines
+    if embedding is None:
+        return
+
+    entry = {
+        "created_at": time.time(),
+        "raw_text": message,
+        "embedding": embedding,
+        "spec": spec,
+    }
+    with _lock:
+        entries = _load_entries()
+        ENTRIES_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with ENTRIES_PATH.open("ab") as f:
+            f.write(_dump_line(entry))
+        _file_lines += 1
+
+        if len(entries) < MAX_ENTRIES:
+            entries.append(entry)
+        else:
+            # Drop the oldest; a new list, so lookups' snapshots are unaffected
+            _entries = entries = entries[len(entries) - MAX_ENTRIES + 1:] + [entry]
+        if _file_lines > 2 * MAX_ENTRIES:
+            _compact(entries)
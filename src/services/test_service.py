@@ -1,6 +1,56 @@
+import functools
+import os
 import subprocess
 import shutil
+import threading
+from collections import deque
 from pathlib import Path
+from typing import Deque, IO, List
+
+# Only the tail of the test output is returned; keep at most this much in memory
+_MAX_TAIL_CHARS = 4000
+# Every line is at least one char ("\n"), so this many lines always cover the last
+# _MAX_TAIL_CHARS characters
+_TAIL_LINES = _MAX_TAIL_CHARS
+
+
+@functools.lru_cache(maxsize=1)
+def _mvn_on_path() -> str:
+    """
+    PATH lookup for `mvn`, done once per process (a failed lookup raises and is
+    not cached, so installing Maven later still works).
+    """
+    mvn = shutil.which("mvn")
+    if mvn is None:
+        raise RuntimeError(
+            "No Maven wrapper (mvnw) or mvn executable found. "
+            "Install Maven or add a test runner script."
+        )
+    return mvn
+
+
+def _resolve_mvn_cmd(repo_path: Path) -> List[str]:
+    """
+    Test command for `repo_path`. The wrapper is probed on every run (one stat),
+    since whether it exists depends on the branch that is checked out.
+    """
+    # Prefer Maven wrapper if present
+    try:
+        os.stat(repo_path / "mvnw")
+        return ["./mvnw", "-q", "test"]
+    except FileNotFoundError:
+        pass
+
+    if not os.path.isdir(repo_path):
+        raise RuntimeError(f"Repo path does not exist: {repo_path}")
+    _mvn_on_path()
+    return ["mvn", "-q", "test"]
+
+
+def _drain(stream: IO[str], tail: Deque[str]) -> None:
+    # Ring buffer: older lines fall off, memory stays O(_TAIL_LINES)
+    for line in stream:
+        tail.append(line)
 
 
 def run_tests_in_repo(repo_path: Path, timeout: int = 600) -> dict:
@@ -17,35 +67,45 @@ def run_tests_in_repo(repo_path: Path, timeout: int = 600) -> dict:
       - stdout: str (tail, truncated)
       - stderr: str (tail, truncated)
     """
-    if not repo_path.exists():
-        raise RuntimeError(f"Repo path does not exist: {repo_path}")
+    cmd = _resolve_mvn_cmd(repo_path)
 
-    # Prefer Maven wrapper if present
-    if (repo_path / "mvnw").exists():
-        cmd = ["./mvnw", "test"]
-    elif shutil.which("mvn"):
-        cmd = ["mvn", "test"]
-    else:
-        raise RuntimeError(
-            "No Maven wrapper (mvnw) or mvn executable found. "
-            "Install Maven or add a test runner script."
-        )
-
-    proc = subprocess.run(
+    proc = subprocess.Popen(
         cmd,
         cwd=repo_path,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         text=True,
-        timeout=timeout,
+        # A stray non-decodable byte must not kill a reader thread (the pipe would
+        # stop draining and Maven would block until the timeout)
+        errors="replace",
+        bufsize=-1,
     )
 
+    # Drain both pipes concurrently (a full stderr pipe would block Maven otherwise)
+    stdout_lines: Deque[str] = deque(maxlen=_TAIL_LINES)
+    stderr_lines: Deque[str] = deque(maxlen=_TAIL_LINES)
+    readers = [
+        threading.Thread(target=_drain, args=(proc.stdout, stdout_lines), daemon=True),
+        threading.Thread(target=_drain, args=(proc.stderr, stderr_lines), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+
     success = proc.returncode == 0
 
     # Keep only the last N characters so response isn't huge
-    max_len = 4000
-    stdout_tail = proc.stdout[-max_len:] if proc.stdout else ""
-    stderr_tail = proc.stderr[-max_len:] if proc.stderr else ""
+    stdout_tail = "".join(stdout_lines)[-_MAX_TAIL_CHARS:]
+    stderr_tail = "".join(stderr_lines)[-_MAX_TAIL_CHARS:]
 
     return {
         "success": success,
@@ -0,0 +1,33 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+# task_id -> ((mtime_ns, size), raw JSON bytes)
+_entries: Dict[str, Tuple[Tuple[int, int], bytes]] = {}
+_lock = threading.Lock()
+_MAX_ENTRIES = 1024
+
+
+def get(task_id: str, version: Tuple[int, int]) -> Optional[bytes]:
+    """
+    Return the cached file bytes for `task_id` if they were read at the same
+    (mtime_ns, size) version as the file on disk now, else None.
+    """
+    with _lock:
+        entry = _entries.get(task_id)
+    if entry is None or entry[0] != version:
+        return None
+    return entry[1]
+
+
+def put(task_id: str, version: Tuple[int, int], raw: bytes) -> None:
+    with _lock:
+        _entries.pop(task_id, None)
+        _entries[task_id] = (version, raw)
+        if len(_entries) > _MAX_ENTRIES:
+            # Dicts keep insertion order; the first key is the least recently stored
+            _entries.pop(next(iter(_entries)))
+
+
+def invalidate(task_id: str) -> None:
+    with _lock:
+        _entries.pop(task_id, None)
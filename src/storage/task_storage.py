@@ -1,88 +1,270 @@
-import json
-from datetime import datetime, timezone
+import heapq
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+
+from src.models.task_spec import TaskSpec
+from src.storage import task_cache
 
 TASKS_DIR = Path("tasks")
+# Per-task paths are built as plain strings (no PurePath allocation per call)
+_TASKS_DIR_STR = str(TASKS_DIR)
+
+# Listing reads many small files; overlap them on a shared pool above this count
+_PARALLEL_READ_THRESHOLD = 8
+_read_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="task-read")
+
+# Listing summaries, one per task, kept in sync by save_task. `list_tasks` serves
+# from this file instead of reading every task; full tasks come from `load_task`.
+_INDEX_PATH = f"{_TASKS_DIR_STR}/_index.json"
+_SUMMARY_FIELDS = {
+    "task_id",
+    "title",
+    "description",
+    "status",
+    "created_at",
+    "last_applied_branch",
+    "last_applied_at",
+    "push_status",
+}
+
+# (index mtime_ns, task_id -> summary); guarded by _index_lock together with the file
+_index_cache: Optional[Tuple[int, Dict[str, Dict[str, Any]]]] = None
+_index_lock = threading.Lock()
+
+
+# Striped per-task locks: a save's reload-merge-write cycle is serialized with
+# other saves of the same task only
+_task_locks = [threading.Lock() for _ in range(64)]
+
+# List fields other writers may append to concurrently; merged by appending
+_APPEND_ONLY = {"timeline", "run_history"}
+
+
+_dir_ready = False
 
 
 def _ensure_dir() -> None:
-    TASKS_DIR.mkdir(parents=True, exist_ok=True)
+    # mkdir once per process instead of an EEXIST syscall on every save/list
+    global _dir_ready
+    if not _dir_ready:
+        TASKS_DIR.mkdir(parents=True, exist_ok=True)
+        _dir_ready = True
 
 
-def save_task(task: Dict[str, Any]) -> None:
+def _atomic_write(path: str, data: bytes) -> Tuple[int, int]:
+    """
+    Replace `path` with `data` atomically: raw open/write/close of a temp file,
+    then os.replace. Readers see either the old or the new file, never a prefix.
+    The temp name is unique per process and thread, so concurrent writers of the
+    same path never truncate or rename each other's temp file.
+    Returns the written file's (mtime_ns, size), taken from the temp file before
+    the rename (which keeps both), so it cannot describe another writer's file.
+    """
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        st = os.fstat(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _task_path(task_id: str) -> str:
+    return f"{_TASKS_DIR_STR}/{task_id}.json"
+
+
+def _snapshot(task: TaskSpec) -> Dict[str, Any]:
+    # Field values as loaded/saved; append-only lists are recorded by length
+    base = task.model_dump(exclude=_APPEND_ONLY)
+    for name in _APPEND_ONLY:
+        base[name] = len(getattr(task, name))
+    return base
+
+
+def _merge_from_disk(task: TaskSpec, current: TaskSpec, base: Dict[str, Any]) -> None:
+    """
+    Rebase `task` onto `current` (the file as saved meanwhile by other writers):
+    fields `task` left unchanged since `base` take the value on disk, and entries
+    `task` appended to the append-only lists go after the ones on disk.
+    """
+    mine = task.model_dump(exclude=_APPEND_ONLY)
+    for name, value in current.model_dump(exclude=_APPEND_ONLY).items():
+        if mine.get(name) == base.get(name):
+            setattr(task, name, value)
+    for name in _APPEND_ONLY:
+        added = getattr(task, name)[base[name]:]
+        setattr(task, name, getattr(current, name) + added)
+
+
+def save_task(task: TaskSpec) -> None:
     """
     Persist a task to disk. The task is stored as a plain JSON file named
     <task_id>.json inside the `tasks/` directory.
 
-    This function expects a plain dict. If you are working with a Pydantic model,
-    call `model_dump(mode="json")` before passing it here.
+    The file is replaced atomically, so a crash mid-write leaves the previous
+    version in place. A task that came from `load_task` is first merged with
+    the file on disk (see `_merge_from_disk`), so a handler that held its copy
+    for minutes only writes its own changes and never reverts another save
+    (e.g. the background push result).
     """
     _ensure_dir()
-    task_id = task.get("task_id")
+    task_id = task.task_id
     if not task_id:
-        raise ValueError("Task dict must include a 'task_id' field")
+        raise ValueError("Task must have a non-empty task_id")
+
+    path = _task_path(task_id)
+    with _task_locks[hash(task_id) % len(_task_locks)]:
+        base = task._base
+        if base is not None:
+            current = _read_task(task_id)
+            if current is not None:
+                _merge_from_disk(task, current, base)
+
+        raw = task.model_dump_json(indent=2).encode("utf-8")
+        task_cache.invalidate(task_id)
+        version = _atomic_write(path, raw)
+        task._base = _snapshot(task)
 
-    path = TASKS_DIR / f"{task_id}.json"
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(task, f, indent=4)
+        # Seed the read cache with what was just written, so the next load_task
+        # (e.g. the push-status poll right after apply) does not re-read the file
+        task_cache.put(task_id, version, raw)
 
+        with _index_lock:
+            index = _load_index()
+            index[task_id] = task.model_dump(include=_SUMMARY_FIELDS)
+            _write_index(index)
 
-def load_task(task_id: str) -> Optional[Dict[str, Any]]:
+
+def load_task(task_id: str) -> Optional[TaskSpec]:
     """
     Load a single task by id. Returns None if the task file does not exist.
+    File bytes are cached in-process and reused while the file's mtime/size
+    are unchanged; every call still returns a freshly validated model.
     """
-    path = TASKS_DIR / f"{task_id}.json"
-    if not path.exists():
+    task = _read_task(task_id)
+    if task is not None:
+        task._base = _snapshot(task)
+    return task
+
+
+def _read_task(task_id: str) -> Optional[TaskSpec]:
+    path = _task_path(task_id)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
         return None
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
 
+    version = (st.st_mtime_ns, st.st_size)
+    raw = task_cache.get(task_id, version)
+    if raw is None:
+        with open(path, "rb") as f:
+            raw = f.read()
+        task_cache.put(task_id, version, raw)
+    return TaskSpec.model_validate_json(raw)
 
-def list_tasks() -> List[Dict[str, Any]]:
+
+def _read_bytes(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        # Deleted between the directory scan and the read
+        return None
+
+
+def _summarize(task: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: task[k] for k in _SUMMARY_FIELDS if k in task}
+
+
+def _rebuild_index() -> Dict[str, Dict[str, Any]]:
     """
-    Return all tasks as a list of dicts, sorted by created_at (newest first).
-    If created_at is missing, those tasks are placed at the end.
+    Full scan of the task files. Only needed when _index.json is missing or
+    unreadable (first start, or a tasks/ directory from before the index).
     """
-    _ensure_dir()
-    tasks: List[Dict[str, Any]] = []
-    for path in TASKS_DIR.glob("*.json"):
+    with os.scandir(TASKS_DIR) as entries:
+        paths = [
+            e.path for e in entries
+            if e.name.endswith(".json") and not e.name.startswith("_") and e.is_file()
+        ]
+
+    if len(paths) > _PARALLEL_READ_THRESHOLD:
+        blobs = list(_read_pool.map(_read_bytes, paths))
+    else:
+        blobs = [_read_bytes(p) for p in paths]
+
+    index: Dict[str, Dict[str, Any]] = {}
+    for blob in blobs:
+        if blob is None:
+            continue
         try:
-            with path.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-                tasks.append(data)
-        except json.JSONDecodeError:
+            task = orjson.loads(blob)
+        except orjson.JSONDecodeError:
             # Skip corrupt files instead of crashing the whole server
             continue
+        if isinstance(task, dict) and task.get("task_id"):
+            index[task["task_id"]] = _summarize(task)
+    return index
 
-    def sort_key(t: Dict[str, Any]) -> str:
-        return t.get("created_at", "")
 
-    tasks.sort(key=sort_key, reverse=True)
-    return tasks
+def _load_index() -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the task_id -> summary map (caller holds _index_lock). Served from
+    memory while _index.json's mtime is unchanged; rebuilt if the file is missing.
+    """
+    global _index_cache
+    _ensure_dir()
+    try:
+        mtime_ns = os.stat(_INDEX_PATH).st_mtime_ns
+    except FileNotFoundError:
+        index = _rebuild_index()
+        _write_index(index)
+        return index
+
+    if _index_cache is not None and _index_cache[0] == mtime_ns:
+        return _index_cache[1]
+
+    try:
+        with open(_INDEX_PATH, "rb") as f:
+            index = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        index = _rebuild_index()
+        _write_index(index)
+        return index
+
+    _index_cache = (mtime_ns, index)
+    return index
+
+
+def _write_index(index: Dict[str, Dict[str, Any]]) -> None:
+    global _index_cache
+    _index_cache = (_atomic_write(_INDEX_PATH, orjson.dumps(index))[0], index)
 
 
-def add_task_event(task_id: str, event: str, details: Optional[str] = None) -> None:
+def list_tasks(limit: Optional[int] = None) -> List[Dict[str, Any]]:
     """
-    Append an event to a task's timeline. Timeline is stored as a simple list
-    of dicts under the 'timeline' key:
-
-        {
-          "at": "<ISO timestamp>",
-          "event": "<short event name>",
-          "details": "<optional details>"
-        }
+    Return a summary of every task (see _SUMMARY_FIELDS), sorted by created_at
+    (newest first). If created_at is missing, those tasks are placed at the end.
+    With `limit`, only the newest `limit` tasks are returned (heap selection,
+    no full sort). Reads only tasks/_index.json; use `load_task` for the full task.
     """
-    task = load_task(task_id)
-    if not task:
-        return
-
-    timeline = task.setdefault("timeline", [])
-    timeline.append(
-        {
-            "at": datetime.now(timezone.utc).isoformat(),
-            "event": event,
-            "details": details,
-        }
-    )
-    save_task(task)
+    with _index_lock:
+        tasks = list(_load_index().values())
+
+    def sort_key(t: Dict[str, Any]) -> str:
+        return t.get("created_at") or ""
+
+    if limit is not None and limit < len(tasks):
+        return heapq.nlargest(limit, tasks, key=sort_key)
+
+    tasks.sort(key=sort_key, reverse=True)
+    return tasks